@@ -1,16 +1,32 @@
+import asyncio
 import fnmatch
-import json
 import os
 import re
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
 from typing import Any, Optional
+from urllib.parse import quote
 
-import requests
+import httpx
+import orjson
 from model import Model
 
 ACCESS_TOKEN = os.getenv("ACCESS_TOKEN", "")
 HEADERS = {"Authorization": f"token {ACCESS_TOKEN}"}
 
-EVENT_DATA = json.loads(os.getenv("GITHUB_EVENT_DATA", "{}"))
+CLIENT = httpx.Client(
+    http2=True, headers=HEADERS, timeout=30, follow_redirects=True
+)
+ACLIENT = httpx.AsyncClient(
+    http2=True,
+    headers=HEADERS,
+    timeout=30,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=32),
+)
+
+EVENT_DATA = orjson.loads(os.getenv("GITHUB_EVENT_DATA", "{}"))
 
 FULL_CONTEXT_MODEL_NAME = os.getenv("FULL_CONTEXT_MODEL", "")
 SINGLE_CHUNK_MODEL_NAME = os.getenv("SINGLE_CHUNK_MODEL", "")
@@ -18,20 +34,100 @@ FULL_CONTEXT_API_KEY = os.getenv("FULL_CONTEXT_API_KEY", "")
 SINGLE_CHUNK_API_KEY = os.getenv("SINGLE_CHUNK_API_KEY", "")
 
 EXCLUDE_PATTERNS = os.getenv("EXCLUDE", "").split(",")
+_EXCLUDE_RE = (
+    re.compile("|".join(fnmatch.translate(p) for p in EXCLUDE_PATTERNS if p))
+    if any(EXCLUDE_PATTERNS)
+    else None
+)
+
+CACHE_DIR = os.getenv("CACHE_DIR", "")
+
+# Files with fewer added and removed lines are left to the full context review.
+MIN_CHANGED_LINES = 2
+BATCH_MAX_CHUNKS = 8
+BATCH_TOKEN_HEADROOM = 1024
+
+_FILE_RE = re.compile(
+    r"(?s)diff --git a/(.+?) b/(.*?)\r?\n(.*?)(?=diff --git a/|$)", re.S
+)
+_OLD_NEW_RE = re.compile(r"(?m)^(---|\+\+\+)\s+(.*)$")
+_HUNK_RE = re.compile(
+    r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(.*?)(?=^@@ |$)",
+    re.MULTILINE | re.DOTALL,
+)
+_FENCE_RE = re.compile(
+    r"^\s*(?:`{3,}(?:(?i:json|markdown)(?!\w))?)?\s*|\s*(?:`{3,})?\s*$"
+)
+
+
+@dataclass(frozen=True)
+class PullRequestContext:
+    """Pull request fields used throughout a review.
+
+    Attributes:
+        title (str): The pull request title.
+        description (str): The pull request description.
+        number (int): The pull request number.
+        diff_url (str): The URL of the pull request diff.
+        repo_url (str): The API URL of the head repository.
+        branch (str): The head branch name.
+        commit_id (str): The head commit SHA.
+        raw_url_prefix (str): The raw file URL up to the encoded file path.
+    """
+
+    title: str
+    description: str
+    number: int
+    diff_url: str
+    repo_url: str
+    branch: str
+    commit_id: str
+    raw_url_prefix: str
+
 
+def load_pr_context() -> PullRequestContext | None:
+    """Load the pull request context from the event data.
 
-def get_diff() -> str | None:
+    Returns:
+        PullRequestContext | None: pull request context, or None if the event
+            has no pull request or its head repository is gone
+    """
+    pull_request = EVENT_DATA.get("pull_request")
+    if pull_request is None:
+        return None
+    head = pull_request.get("head") or {}
+    if not head.get("repo"):
+        return None
+    repo_url = head["repo"]["url"]
+    branch = head["ref"]
+    return PullRequestContext(
+        title=pull_request["title"],
+        description=pull_request["body"],
+        number=pull_request["number"],
+        diff_url=pull_request["diff_url"],
+        repo_url=repo_url,
+        branch=branch,
+        commit_id=head["sha"],
+        raw_url_prefix=f"{repo_url}/raw/{quote(branch, safe='')}%2F",
+    )
+
+
+def get_diff(pr_context: PullRequestContext) -> str | None:
     """Get code difference between base and head from Gitea.
 
+    Args:
+        pr_context: PullRequestContext, pull request under review
+
     Returns:
         str | None: code difference between base and head, or None if failed to get diff
     """
-    url = EVENT_DATA["pull_request"]["diff_url"]
+    url = pr_context.diff_url
     try:
-        response = requests.get(url, headers=HEADERS)
+        response = CLIENT.get(url)
         response.raise_for_status()
-        return response.text
-    except requests.RequestException as e:
+        # Git diffs are UTF-8; decoding directly skips charset detection.
+        return response.content.decode("utf-8", errors="replace")
+    except httpx.HTTPError as e:
         print(f"Failed to get diff: {e}")
         return None
 
@@ -45,57 +141,55 @@ def parse_diff(diff: str) -> list[dict[str, Any]]:
     Returns:
         list[dict[str, Any]]: list of dicts, each dict represents a code chunks
     """
-    file_pattern = re.compile(
-        r"(?s)diff --git a/(.+?) b/(.*?)\r?\n(.*?)(?=diff --git a/|$)", re.S
-    )
-    old_new_pattern = re.compile(r"(?m)^(---|\+\+\+)\s+(.*)$")
-    hunk_pattern = re.compile(
-        r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(.*?)(?=^@@ |$)",
-        re.MULTILINE | re.DOTALL,
-    )
     list_diff = []
-    for match in file_pattern.finditer(diff):
+    for match in _FILE_RE.finditer(diff):
         diff_text = match.group(3)
 
-        old_new_match = list(old_new_pattern.finditer(diff_text))
+        old_new_match = list(_OLD_NEW_RE.finditer(diff_text))
         if len(old_new_match) != 2:
             continue
 
         old_file = old_new_match[0].group(2)
-        old_file = old_file.lstrip("a/") if old_file.startswith("a/") else old_file
+        old_file = old_file.removeprefix("a/")
 
         new_file = old_new_match[1].group(2)
         if new_file == "/dev/null":
             print("Neglict deleted file")
             continue
-        new_file = new_file.lstrip("b/")
+        new_file = new_file.removeprefix("b/")
+        if _EXCLUDE_RE is not None and _EXCLUDE_RE.match(new_file):
+            print(f"Exclude file {new_file}")
+            continue
 
-        hunk_match = hunk_pattern.search(diff_text)
+        hunk_match = _HUNK_RE.search(diff_text)
         if hunk_match is None:
             continue
         old_idx = int(hunk_match.group(1))
         new_idx = int(hunk_match.group(3))
-        remain_text = diff_text[hunk_match.end() + 1 :]
-        diff_text = []
-        for line in remain_text.splitlines():
-            if line.startswith("-"):
-                diff_text.append(f"{old_idx} {line}")
+        lines = diff_text[hunk_match.end() + 1 :].splitlines()
+        numbered_lines = [""] * len(lines)
+        additions = 0
+        deletions = 0
+        for i, line in enumerate(lines):
+            first = line[:1]
+            if first == "-":
+                numbered_lines[i] = f"{old_idx} {line}"
                 old_idx += 1
-            elif line.startswith("+"):
-                diff_text.append(f"{new_idx} {line}")
+                deletions += 1
+            elif first == "+":
+                numbered_lines[i] = f"{new_idx} {line}"
                 new_idx += 1
+                additions += 1
             else:
-                diff_text.append(line)
-        diff_text = "\n".join(diff_text)
-
-        if any(fnmatch.fnmatch(new_file, pattern) for pattern in EXCLUDE_PATTERNS):
-            print(f"Exclude file {new_file}")
-            continue
+                numbered_lines[i] = line
+        diff_text = "\n".join(numbered_lines)
 
         list_diff.append(
             {
                 "file": new_file,
                 "chunk": diff_text,
+                "additions": additions,
+                "changes": additions + deletions,
             }
         )
     return list_diff
@@ -113,22 +207,169 @@ def create_comment(
     Returns:
         list[dict[str, Any]]: comments for single chunk review
     """
-    comments = []
-    for ai_response in ai_response:
-        comments.append(
-            {
-                "body": f"[REVIEW] {ai_response['reviewComment']}",
-                "path": file,
-                "new_position": int(ai_response["lineNumber"]),
-            }
+    return [
+        {
+            "body": f"[REVIEW] {response['reviewComment']}",
+            "path": file,
+            "new_position": int(response["lineNumber"]),
+        }
+        for response in ai_response
+    ]
+
+
+def batch_chunks(
+    parsed_diff: list[dict[str, Any]], token_budget: int
+) -> list[list[dict[str, Any]]]:
+    """Greedily pack consecutive chunks into batches for a single request.
+
+    Args:
+        parsed_diff: list[dict[str, Any]], parsed diff
+        token_budget: int, estimated prompt tokens allowed per batch
+
+    Returns:
+        list[list[dict[str, Any]]]: batches of parsed diffs, in diff order
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for diff in parsed_diff:
+        tokens = len(diff["chunk"]) // 4
+        if batch and (
+            batch_tokens + tokens > token_budget or len(batch) >= BATCH_MAX_CHUNKS
+        ):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(diff)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def resolve_cache_dir(cache_dir: str) -> str | None:
+    """Resolve the response cache directory outside the job workspace.
+
+    The workspace holds the checked-out pull request, so a cache inside it could
+    be planted by the PR author. Relative paths are placed under RUNNER_TEMP.
+
+    Args:
+        cache_dir: str, configured cache directory, empty to disable caching
+
+    Returns:
+        str | None: absolute cache directory, or None if caching is disabled
+    """
+    if not cache_dir:
+        return None
+    path = Path(os.getenv("RUNNER_TEMP", tempfile.gettempdir()), cache_dir).resolve()
+    workspace = os.getenv("GITHUB_WORKSPACE")
+    if workspace and path.is_relative_to(Path(workspace).resolve()):
+        print(f"Cache directory {path} is inside the workspace, caching disabled.")
+        return None
+    return str(path)
+
+
+def is_review_item(ai_response: Any) -> bool:
+    """Check that an AI review item can be turned into a comment.
+
+    Args:
+        ai_response: Any, item of the AI response array
+
+    Returns:
+        bool: whether the item is a dict with a reviewComment and an integer
+            lineNumber
+    """
+    if not isinstance(ai_response, dict) or "reviewComment" not in ai_response:
+        return False
+    try:
+        int(ai_response.get("lineNumber"))
+    except (TypeError, ValueError, OverflowError):
+        return False
+    return True
+
+
+def parse_chunk_reviews(
+    batch: list[dict[str, Any]], response: str
+) -> list[list[dict[str, Any]]] | None:
+    """Parse a single chunk or batched response into per-chunk reviews.
+
+    Args:
+        batch: list[dict[str, Any]], parsed diffs sent in the request
+        response: str, AI response for the request
+
+    Returns:
+        list[list[dict[str, Any]]] | None: valid AI review items for each chunk
+            in the batch, or None if the response is not a JSON array
+    """
+    response = _FENCE_RE.sub("", response) or "[]"
+    try:
+        response_json = orjson.loads(response)
+    except orjson.JSONDecodeError:
+        response_json = None
+    if not isinstance(response_json, list):
+        print(f"Failed to parse response: {response}")
+        return None
+
+    items = []
+    for ai_response in response_json:
+        if not is_review_item(ai_response):
+            print(f"Invalid item in response: {ai_response}")
+            continue
+        items.append(ai_response)
+
+    if len(batch) == 1:
+        return [items]
+
+    reviews = [[] for _ in batch]
+    for ai_response in items:
+        chunk_id = str(ai_response.get("chunkId"))
+        if not chunk_id.isdigit() or int(chunk_id) >= len(batch):
+            print(f"Unknown chunk in response: {ai_response}")
+            continue
+        reviews[int(chunk_id)].append(ai_response)
+    return reviews
+
+
+async def arequest_chunk_reviews(
+    single_chunk_model: Model, batches: list[list[dict[str, Any]]]
+) -> list[list[list[dict[str, Any]]] | None]:
+    """Request reviews for batches of chunks concurrently.
+
+    Args:
+        single_chunk_model: AI Session for single chunk analysis
+        batches: list[list[dict[str, Any]]], batches of parsed diffs
+
+    Returns:
+        list[list[list[dict[str, Any]]] | None]: AI review items for each chunk
+            of each batch, or None for a batch whose request or parsing failed
+    """
+    tasks = [
+        (
+            single_chunk_model.aget_response_single_chunk(
+                batch[0]["file"], batch[0]["chunk"]
+            )
+            if len(batch) == 1
+            else single_chunk_model.aget_response_batched_chunks(batch)
         )
-    return comments
+        for batch in batches
+    ]
+    responses = await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = []
+    for batch, response in zip(batches, responses):
+        if isinstance(response, Exception):
+            files = ", ".join(diff["file"] for diff in batch)
+            print(f"Failed to get response for {files}: {response}")
+            results.append(None)
+            continue
+        results.append(parse_chunk_reviews(batch, response))
+    return results
 
 
-def analyze_single_chunks(
+async def analyze_single_chunks(
     single_chunk_model: Model, parsed_diff: list[dict[str, Any]]
 ) -> list[dict[str, Any]]:
-    """Analyze single chunks and create comments.
+    """Analyze single chunks in concurrent, batched requests and create comments.
 
     Args:
         single_chunk_model: AI Session for single chunk analysis
@@ -137,114 +378,181 @@ def analyze_single_chunks(
     Returns:
         list[dict[str, Any]]: comments for single chunk review
     """
-    comments = []
-    title = EVENT_DATA["pull_request"]["title"]
-    description = EVENT_DATA["pull_request"]["body"]
+    reviewable_diff = []
     for diff in parsed_diff:
-        file = diff["file"]
-        chunk = diff["chunk"]
-        response = single_chunk_model.get_response_single_chunk(
-            file, title, description, chunk
+        if diff["additions"] == 0:
+            print(f"Skip file without additions {diff['file']}")
+            continue
+        if diff["changes"] < MIN_CHANGED_LINES:
+            print(f"Skip file with too few changed lines {diff['file']}")
+            continue
+        reviewable_diff.append(diff)
+
+    # Look up each chunk before packing, so a changed chunk does not invalidate
+    # the cached reviews of the chunks batched around it.
+    comments = []
+    pending_diff = []
+    for diff in reviewable_diff:
+        cached = single_chunk_model.get_cached_review(diff["file"], diff["chunk"])
+        reviews = None if cached is None else parse_chunk_reviews([diff], cached)
+        if reviews is None:
+            pending_diff.append(diff)
+        else:
+            comments.extend(create_comment(diff["file"], reviews[0]))
+
+    batches = (
+        batch_chunks(
+            pending_diff, single_chunk_model.max_tokens - BATCH_TOKEN_HEADROOM
         )
-        response = response.strip("`").lstrip("json").strip() or "[]"
-
-        try:
-            response_json = json.loads(response)
-            new_comments = create_comment(file, response_json)
-            comments.extend(new_comments)
-        except json.JSONDecodeError:
-            print(f"Failed to parse response: {response}")
+        if single_chunk_model.supports_batching
+        else [[diff] for diff in pending_diff]
+    )
+    results = await arequest_chunk_reviews(single_chunk_model, batches)
+
+    # Batched chunks share one output token cap, so a truncated or malformed
+    # reply would lose all of them. Retry those chunks one request each.
+    retry_batches = [
+        [diff]
+        for batch, reviews in zip(batches, results)
+        if reviews is None and len(batch) > 1
+        for diff in batch
+    ]
+    batches += retry_batches
+    results += await arequest_chunk_reviews(single_chunk_model, retry_batches)
+
+    for batch, reviews in zip(batches, results):
+        if reviews is None:
             continue
+        for diff, ai_response in zip(batch, reviews):
+            single_chunk_model.set_cached_review(
+                diff["file"], diff["chunk"], orjson.dumps(ai_response).decode()
+            )
+            comments.extend(create_comment(diff["file"], ai_response))
 
     return comments
 
 
-def get_file_content(file: str) -> str | None:
-    """Get file content from Gitea.
+async def aget_file_content(pr_context: PullRequestContext, file: str) -> str | None:
+    """Get file content from Gitea asynchronously.
 
     Args:
+        pr_context: PullRequestContext, pull request under review
         file: str, file name
 
     Returns:
         str | None: file content, or None if failed to get file content
     """
-    repo_url = EVENT_DATA["pull_request"]["head"]["repo"]["url"]
-    branch = EVENT_DATA["pull_request"]["head"]["ref"]
-
-    replaced_file = file.replace("/", "%2F")
-    url = f"{repo_url}/raw/{branch}%2F{replaced_file}?ref={branch}"
+    url = f"{pr_context.raw_url_prefix}{quote(file, safe='')}"
 
     try:
-        response = requests.get(url, headers=HEADERS)
+        response = await ACLIENT.get(url, params={"ref": pr_context.branch})
         response.raise_for_status()
         return response.text
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to get file content: {e}")
         return None
 
 
-def analyze_full_context(
-    full_context_model: Model, parsed_diff: list[dict[str, Any]]
+async def analyze_full_context(
+    pr_context: PullRequestContext,
+    full_context_model: Model,
+    parsed_diff: list[dict[str, Any]],
 ) -> str:
     """Analyze full context and create review.
 
     Args:
+        pr_context: PullRequestContext, pull request under review
         full_context_model: AI Session for full context analysis
         parsed_diff: list[dict[str, Any]], parsed diff
 
     Returns:
         str: review for full context
     """
+    files = list(dict.fromkeys(diff["file"] for diff in parsed_diff))
+    contents = await asyncio.gather(
+        *[aget_file_content(pr_context, file) for file in files]
+    )
+    content_by_file = dict(zip(files, contents))
+
     file_contents = []
     for diff in parsed_diff:
-        file = diff["file"]
-        chunk = diff["chunk"]
-        content = get_file_content(file)
+        content = content_by_file[diff["file"]]
         if content is None:
             continue
-        file_contents.append(f"File: {file}")
+        file_contents.append(f"File: {diff['file']}")
         file_contents.append(content)
-        file_contents.append(f"Diff: {chunk}")
+        file_contents.append(f"Diff: {diff['chunk']}")
 
-    title = EVENT_DATA["pull_request"]["title"]
-    description = EVENT_DATA["pull_request"]["body"]
-    response = full_context_model.get_response_full_context(
-        title, description, file_contents
-    )
-    response = response.strip("`").lstrip("markdown").strip()
+    response = await full_context_model.aget_response_full_context(file_contents)
+    response = _FENCE_RE.sub("", response)
     return response
 
 
 def post_review(
-    full_context_review: str, single_chunk_comments: list[dict[str, Any]]
+    pr_context: PullRequestContext,
+    full_context_review: str,
+    single_chunk_comments: list[dict[str, Any]],
 ) -> None:
     """Post review to Gitea.
 
     Args:
+        pr_context: PullRequestContext, pull request under review
         full_context_review: str, review for full context
         single_chunk_comments: list[dict[str, Any]], comments for single chunk review
     """
-    repo_url = EVENT_DATA["pull_request"]["head"]["repo"]["url"]
-    pull_number = EVENT_DATA["number"]
-    commit_id = EVENT_DATA["pull_request"]["head"]["sha"]
-    url = f"{repo_url}/pulls/{pull_number}/reviews"
+    url = f"{pr_context.repo_url}/pulls/{pr_context.number}/reviews"
     data = {
         "body": full_context_review,
         "event": "COMMENT",
         "comments": single_chunk_comments,
-        "commit_id": commit_id,
+        "commit_id": pr_context.commit_id,
     }
-    response = requests.post(url, headers=HEADERS, json=data)
+    response = CLIENT.post(url, json=data)
     response.raise_for_status()
 
 
+async def review(
+    pr_context: PullRequestContext,
+    single_chunk_model: Model,
+    full_context_model: Model,
+    parsed_diff: list[dict[str, Any]],
+) -> tuple[list[dict[str, Any]], str]:
+    """Run single chunk and full context reviews concurrently.
+
+    Args:
+        pr_context: PullRequestContext, pull request under review
+        single_chunk_model: AI Session for single chunk analysis
+        full_context_model: AI Session for full context analysis
+        parsed_diff: list[dict[str, Any]], parsed diff
+
+    Returns:
+        tuple[list[dict[str, Any]], str]: comments for single chunk review
+            and review for full context
+    """
+    try:
+        # Full context goes first so its file fetches are sent to Gitea before
+        # the single chunk requests fan out to the model provider.
+        full_context_review, comments = await asyncio.gather(
+            analyze_full_context(pr_context, full_context_model, parsed_diff),
+            analyze_single_chunks(single_chunk_model, parsed_diff),
+        )
+    finally:
+        await ACLIENT.aclose()
+    return comments, full_context_review
+
+
 def main() -> None:
     """Code Reviewer for Gitea."""
     if EVENT_DATA["action"] not in ["opened", "synchronized"]:
         print("Unsupproted event.")
         return
 
-    diff = get_diff()
+    pr_context = load_pr_context()
+    if pr_context is None:
+        print("No pull request head repository found.")
+        return
+
+    diff = get_diff(pr_context)
     if diff is None:
         return
     elif not diff:
@@ -260,12 +568,17 @@ def main() -> None:
         model=SINGLE_CHUNK_MODEL_NAME,
         api_key=SINGLE_CHUNK_API_KEY,
         is_full_context=False,
+        cache_dir=resolve_cache_dir(CACHE_DIR),
     )
 
+    full_context_model.bind_pr(pr_context.title, pr_context.description)
+    single_chunk_model.bind_pr(pr_context.title, pr_context.description)
+
     parsed_diff = parse_diff(diff)
-    comments = analyze_single_chunks(single_chunk_model, parsed_diff)
-    full_context_response = analyze_full_context(full_context_model, parsed_diff)
-    post_review(full_context_response, comments)
+    comments, full_context_response = asyncio.run(
+        review(pr_context, single_chunk_model, full_context_model, parsed_diff)
+    )
+    post_review(pr_context, full_context_response, comments)
 
 
 if __name__ == "__main__":
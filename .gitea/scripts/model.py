@@ -1,9 +1,11 @@
+import hashlib
 from enum import Enum
 from typing import Any
 
 import google.generativeai as genai
-from anthropic import Anthropic
-from openai import OpenAI
+from anthropic import AsyncAnthropic
+from diskcache import Cache, JSONDisk
+from openai import AsyncOpenAI
 
 
 class ModelProvider(Enum):
@@ -46,7 +48,10 @@ class Model:
         model (str): The model name.
         api_key (str): The API key.
         system_prompt (str): The system prompt.
+        pr_prompt (str): The user prompt preamble bound to the pull request.
         max_tokens (int): The maximum tokens.
+        cache (Cache | None): The on-disk cache for chunk responses.
+        supports_batching (bool): Whether several chunks may share one request.
     """
 
     def __init__(  # noqa: D107
@@ -55,6 +60,7 @@ class Model:
         api_key: str,
         is_full_context: bool,
         max_tokens: int = 4196,
+        cache_dir: str | None = None,
     ):
         self.model = model
         self.system_prompt = (
@@ -62,136 +68,270 @@ class Model:
             if is_full_context
             else SINGLE_CHUNK_SYSTEM_PROMPT
         )
+        self.pr_prompt_template = (
+            FULL_CONTEXT_PR_PROMPT if is_full_context else SINGLE_CHUNK_PR_PROMPT
+        )
+        self.pr_prompt = ""
+        self.anthropic_system = [
+            {
+                "type": "text",
+                "text": self.system_prompt,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+        self.anthropic_batched_system = [
+            {
+                "type": "text",
+                "text": BATCHED_CHUNK_SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
+        self.anthropic_preamble = []
         self.max_tokens = max_tokens
+        self.cache = Cache(cache_dir, disk=JSONDisk) if cache_dir else None
         self.provider = ModelProvider.from_model(model)
+        # Gemini requests carry no system prompt, so it never learns the chunkId
+        # contract that batched replies are split by.
+        self.supports_batching = self.provider is not ModelProvider.GOOGLE
+        # The provider is fixed, so resolve request dispatch once here.
+        self._arequest = {
+            ModelProvider.OPENAI: self._arequest_openai,
+            ModelProvider.DEEPSEEK: self._arequest_openai,
+            ModelProvider.ANTHROPIC: self._arequest_anthropic,
+            ModelProvider.GOOGLE: self._arequest_google,
+        }[self.provider]
         self.session = self.create_session(api_key)
 
     def create_session(self, api_key: str) -> Any:
-        """Create a session for the model.
+        """Create an async session for the model.
 
         Args:
             api_key (str): The API key.
 
         Returns:
-            Any: The session.
+            Any: The async session.
         """
         match self.provider:
             case ModelProvider.OPENAI:
-                return OpenAI(api_key=api_key)
+                return AsyncOpenAI(api_key=api_key)
             case ModelProvider.ANTHROPIC:
-                return Anthropic(api_key=api_key)
+                return AsyncAnthropic(api_key=api_key)
             case ModelProvider.GOOGLE:
                 genai.configure(api_key=api_key)
                 return genai.GenerativeModel(model=self.model, api_key=api_key)
             case ModelProvider.DEEPSEEK:
-                return OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
+                return AsyncOpenAI(api_key=api_key, base_url="https://api.deepseek.com")
+
+    def bind_pr(self, title: str, description: str) -> None:
+        """Bind the pull request title and description to the model.
+
+        The preamble is formatted once per review and prepended to every prompt.
+        For Anthropic it is sent as a cacheable first block of the user message,
+        so concurrent chunk requests share the whole PR-level prefix while the
+        author-controlled text stays out of the system prompt.
+
+        Args:
+            title (str): The pull request title.
+            description (str): The pull request description.
+        """
+        self.pr_prompt = self.pr_prompt_template.format(title, description)
+        self.anthropic_preamble = [
+            {
+                "type": "text",
+                "text": self.pr_prompt,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
 
-    def request(self, prompt: str) -> str:
-        """Request the model to generate a response.
+    async def arequest(self, prompt: str, batched: bool = False) -> str:
+        """Request the model to generate a response asynchronously.
 
         Args:
-            prompt (str): The prompt to generate a response for.
+            prompt (str): The prompt, following the bound pull request preamble.
+            batched (bool): Whether the prompt packs several diff chunks.
 
         Returns:
             str: The generated response.
         """
-        match self.provider:
-            case ModelProvider.OPENAI | ModelProvider.DEEPSEEK:
-                response = self.session.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": self.system_prompt},
-                        {"role": "user", "content": prompt},
-                    ],
-                    temperature=0.2,
-                    max_tokens=self.max_tokens,
-                    top_p=1,
-                    frequency_penalty=0,
-                    presence_penalty=0,
-                )
-                return response.choices[0].message.content.strip()
-            case ModelProvider.ANTHROPIC:
-                response = self.session.messages.create(
-                    model=self.model,
-                    messages=[{"role": "user", "content": prompt}],
-                    system=[
-                        {
-                            "type": "text",
-                            "text": self.system_prompt,
-                            "cache_control": {"type": "ephemeral"},
-                        }
+        return await self._arequest(prompt, batched)
+
+    def _openai_messages(self, prompt: str, batched: bool) -> list[dict[str, str]]:
+        system_prompt = BATCHED_CHUNK_SYSTEM_PROMPT if batched else self.system_prompt
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": self.pr_prompt + prompt},
+        ]
+
+    async def _arequest_openai(self, prompt: str, batched: bool) -> str:
+        response = await self.session.chat.completions.create(
+            model=self.model,
+            messages=self._openai_messages(prompt, batched),
+            temperature=0.2,
+            max_tokens=self.max_tokens,
+            top_p=1,
+            frequency_penalty=0,
+            presence_penalty=0,
+        )
+        return response.choices[0].message.content.strip()
+
+    async def _arequest_anthropic(self, prompt: str, batched: bool) -> str:
+        response = await self.session.messages.create(
+            model=self.model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        *self.anthropic_preamble,
+                        {"type": "text", "text": prompt},
                     ],
-                    temperature=0.2,
-                    max_tokens=self.max_tokens,
-                )
-                return response.content[0].text.strip()
-            case ModelProvider.GOOGLE:
-                response = self.session.generate_content(prompt)
-                return response.text.strip()
+                }
+            ],
+            system=self.anthropic_batched_system if batched else self.anthropic_system,
+            temperature=0.2,
+            max_tokens=self.max_tokens,
+        )
+        return response.content[0].text.strip()
 
-    def get_response_single_chunk(
-        self, file: str, title: str, description: str, chunk: str
-    ) -> str:
-        """Get the response for a single chunk.
+    async def _arequest_google(self, prompt: str, batched: bool) -> str:
+        response = await self.session.generate_content_async(
+            self.pr_prompt + prompt
+        )
+        return response.text.strip()
+
+    def cache_key(self, file: str, chunk: str) -> str:
+        """Get the cache key for a single chunk review.
+
+        Args:
+            file (str): The file name.
+            chunk (str): The diff chunk.
+
+        Returns:
+            str: The hex digest over everything that shapes the review.
+        """
+        key = "\0".join((self.model, self.system_prompt, self.pr_prompt, file, chunk))
+        return hashlib.blake2b(key.encode()).hexdigest()
+
+    def get_cached_review(self, file: str, chunk: str) -> str | None:
+        """Get the cached review for a single chunk.
+
+        Args:
+            file (str): The file name.
+            chunk (str): The diff chunk.
+
+        Returns:
+            str | None: The cached review as a JSON array, or None on a miss.
+        """
+        if self.cache is None:
+            return None
+        review = self.cache.get(self.cache_key(file, chunk))
+        return review if isinstance(review, str) else None
+
+    def set_cached_review(self, file: str, chunk: str, review: str) -> None:
+        """Cache the review for a single chunk.
+
+        Args:
+            file (str): The file name.
+            chunk (str): The diff chunk.
+            review (str): The review as a JSON array, already checked to parse.
+        """
+        if self.cache is not None:
+            self.cache.set(self.cache_key(file, chunk), review)
+
+    async def aget_response_single_chunk(self, file: str, chunk: str) -> str:
+        """Get the response for a single chunk asynchronously.
 
         Args:
             file (str): The file name.
-            title (str): The pull request title.
-            description (str): The pull request description.
             chunk (str): The diff chunk.
 
         Returns:
             str: The response.
         """
-        prompt = SINGLE_CHUNK_USER_PROMPT.format(file, title, description, chunk)
-        return self.request(prompt)
+        prompt = SINGLE_CHUNK_USER_PROMPT.format(file, chunk)
+        return await self.arequest(prompt)
+
+    async def aget_response_batched_chunks(self, batch: list[dict[str, Any]]) -> str:
+        """Get the response for several chunks packed into one request asynchronously.
 
-    def get_response_full_context(
-        self, title: str, description: str, file_contents: list[str]
-    ) -> str:
-        """Get the response for full context.
+        Each chunk is identified by its index in the batch, which the model
+        echoes back as chunkId.
+
+        Args:
+            batch (list[dict[str, Any]]): The parsed diffs, with file and chunk.
+
+        Returns:
+            str: The response.
+        """
+        prompt = "\n".join(
+            BATCHED_CHUNK_USER_PROMPT.format(chunk_id, diff["file"], diff["chunk"])
+            for chunk_id, diff in enumerate(batch)
+        )
+        return await self.arequest(prompt, batched=True)
+
+    async def aget_response_full_context(self, file_contents: list[str]) -> str:
+        """Get the response for full context asynchronously.
 
         Args:
-            title (str): The pull request title.
-            description (str): The pull request description.
             file_contents (list[str]): The file contents, diffs.
 
         Returns:
             str: The response.
         """
         try:
-            prompt = FULL_CONTEXT_USER_PROMPT.format(
-                title, description, "\n".join(file_contents)
-            )
-            return self.request(prompt)
+            prompt = FULL_CONTEXT_USER_PROMPT.format("\n".join(file_contents))
+            return await self.arequest(prompt)
         except Exception as e:
             print(f"Error during full context response: {e}")
             print(prompt)
             return None
 
 
-SINGLE_CHUNK_SYSTEM_PROMPT = (
-    "Your task is to review pull requests. Instructions:\n"
-    "- Provide the response in the following JSON format:  "
-    """[{{"lineNumber":  <line_number>, "reviewComment": "<review comment>"}}] \n"""
+CHUNK_REVIEW_INSTRUCTIONS = (
     "- lineNumber is about the line number of the code that in new file. \n"
     "- Do not give positive comments or compliments. \n"
-    "- Provide comments and suggestions ONLY if there is something to improve"
+    "- Provide comments and suggestions ONLY if there is something to improve, "
     "otherwise return an empty array. \n"
     "- Write the comment in GitHub Markdown format. \n"
     "- Use the given description only for the overall context "
     "and only comment the code. \n"
     "- IMPORTANT: NEVER suggest adding comments to the code. \n"
 )
-SINGLE_CHUNK_USER_PROMPT = (
-    "Review the following code diff in the file "
-    "{} and take the pull request title and description into account "
-    "when writing the response. \n"
+
+SINGLE_CHUNK_SYSTEM_PROMPT = (
+    "Your task is to review pull requests. Instructions:\n"
+    "- Provide the response in the following JSON format:  "
+    """[{"lineNumber":  <line_number>, "reviewComment": "<review comment>"}] \n"""
+    + CHUNK_REVIEW_INSTRUCTIONS
+)
+SINGLE_CHUNK_PR_PROMPT = (
+    "Review the following code diff and take the pull request title "
+    "and description into account when writing the response. \n"
     "Pull request title: {} \n"
     "Pull request description: \n"
     "--- \n"
     "{} \n"
     "--- \n"
+)
+SINGLE_CHUNK_USER_PROMPT = (
+    "File: {} \n"
+    "Git diff to review: \n"
+    "```diff \n"
+    "{} \n"
+    "```"
+)
+
+BATCHED_CHUNK_SYSTEM_PROMPT = (
+    "Your task is to review pull requests. Instructions:\n"
+    "- You are given several code diffs, each labelled with a chunk ID. \n"
+    "- Provide the response in the following JSON format:  "
+    """[{"chunkId": <chunk_id>, "lineNumber":  <line_number>, """
+    """"reviewComment": "<review comment>"}] \n"""
+    "- chunkId is the chunk ID of the diff the comment is about. \n"
+    + CHUNK_REVIEW_INSTRUCTIONS
+)
+BATCHED_CHUNK_USER_PROMPT = (
+    "Chunk ID: {} \n"
+    "File: {} \n"
     "Git diff to review: \n"
     "```diff \n"
     "{} \n"
@@ -222,7 +362,7 @@ FULL_CONTEXT_SYSTEM_PROMPT = (
     "- IMPORTANT: Give example code block or pseudo code if you can.\n"
 )
 
-FULL_CONTEXT_USER_PROMPT = (
+FULL_CONTEXT_PR_PROMPT = (
     "Review the following code and take the pull request title "
     "and description into account when writing the response. \n"
     "Pull request title: {} \n"
@@ -230,6 +370,8 @@ FULL_CONTEXT_USER_PROMPT = (
     "--- \n"
     "{} \n"
     "--- \n"
+)
+FULL_CONTEXT_USER_PROMPT = (
     "Code to review: \n"
     "{}"
 )